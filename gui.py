@@ -6,20 +6,45 @@ Date: 2025-12-29
 """
 
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox
+from tkinter import ttk, scrolledtext
 import threading
-import queue
+from collections import deque
 import json
 import os
 import time
-import webbrowser
-import pyperclip
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 
 # 导入核心逻辑类
 from main import MiNoteSyncCore
 
+# 日志区最多保留的行数，超出后丢弃最早的日志，避免 Text 控件越来越卡
+MAX_LOG_LINES = 2000
+# 默认并发处理笔记的线程数 (同步基本是网络等待，线程数可以高于 CPU 核数)；
+# 可在 config.json 中用 "max_workers" 覆盖。对服务器的并发请求数另由核心类限制
+SYNC_WORKERS = min(16, (os.cpu_count() or 1) * 4)
+# 待显示日志的积压上限，界面跟不上时丢弃最早的日志
+MAX_LOG_BACKLOG = 10000
+
+# 默认保存路径，启动时计算一次
+_DEFAULT_PATH = os.path.join(os.getcwd(), "Data", "Notes")
+
+# Windows 剪贴板序列号：内容每变化一次递增，读取它无需打开剪贴板
+try:
+    import ctypes
+    _GetClipboardSequenceNumber = ctypes.windll.user32.GetClipboardSequenceNumber
+except Exception:
+    _GetClipboardSequenceNumber = None
+
+# 日志时间戳缓存：同一秒内的日志复用已格式化的字符串
+_ts_cache = [0, ""]
+
+def _ts():
+    s = int(time.time())
+    if s != _ts_cache[0]:
+        _ts_cache[:] = [s, time.strftime("%H:%M:%S", time.localtime(s))]
+    return _ts_cache[1]
+
 class MiNoteGUI:
     def __init__(self, root):
         self.root = root
@@ -27,44 +52,48 @@ class MiNoteGUI:
         self.root.geometry("850x700") # 稍微调高一点
         
         self.config_file = "config.json"
-        self.log_queue = queue.Queue()
+        self.log_queue = deque(maxlen=MAX_LOG_BACKLOG) # 单消费者，append/popleft 本身线程安全
+        self._log_dropped = 0
         self.core_instance = None
         self.is_running = False
+        self._log_idle_ticks = 0
         
         self.load_config()
+        # 同步线程池在整个程序生命周期内复用，关闭窗口时再释放
+        try: self.workers = max(1, int(self.config.get("max_workers", SYNC_WORKERS)))
+        except (TypeError, ValueError): self.workers = SYNC_WORKERS # 配置值无法解析时使用默认值
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="minote")
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
         self.create_widgets()
         self.update_log_display()
         
     def log(self, message):
         """核心类调用的回调函数，将日志推入队列"""
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.log_queue.put(f"[{timestamp}] {message}")
+        if len(self.log_queue) == MAX_LOG_BACKLOG: self._log_dropped += 1
+        self.log_queue.append(f"[{_ts()}] {message}")
 
     def load_config(self):
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    self.config = json.load(f)
-            else:
-                self.config = {
-                    "cookie": "", 
-                    "path": os.path.join(os.getcwd(), "Data", "Notes"),
-                    "use_date_prefix": True
-                }
+            with open(self.config_file, 'r', encoding='utf-8') as f:
+                self.config = json.load(f)
         except:
-            self.config = {
-                "cookie": "", 
-                "path": os.path.join(os.getcwd(), "Data", "Notes"),
-                "use_date_prefix": True
-            }
+            # 配置文件不存在或已损坏时使用默认配置
+            self.config = {"cookie": "", "path": _DEFAULT_PATH, "use_date_prefix": True}
+        # 记录磁盘上的配置，保存时内容未变则跳过写盘
+        self._last_saved_config = dict(self.config)
             
     def save_config(self):
         self.config["cookie"] = self.cookie_var.get()
         self.config["path"] = self.path_var.get()
         self.config["use_date_prefix"] = self.date_prefix_var.get()
+        if self.config == self._last_saved_config: return
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, ensure_ascii=False, indent=2)
+            # 先写临时文件再替换，避免写到一半时留下损坏的 config.json
+            tmp_file = self.config_file + ".tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(json.dumps(self.config, ensure_ascii=False, indent=2).encode('utf-8'))
+            os.replace(tmp_file, self.config_file)
+            self._last_saved_config = dict(self.config)
         except Exception as e:
             self.log(f"❌ 保存配置失败: {e}")
 
@@ -129,45 +158,83 @@ class MiNoteGUI:
         ttk.Button(main_frame, text="清除日志", command=self.clear_log).pack(anchor=tk.E, pady=5)
 
     def update_log_display(self):
+        # 一次性取空队列，合并为单次 insert，避免高并发日志下逐条刷新界面
+        msgs = []
         try:
-            while not self.log_queue.empty():
-                msg = self.log_queue.get_nowait()
+            while True:
+                msgs.append(self.log_queue.popleft())
+        except IndexError:
+            pass
+        if self._log_dropped:
+            msgs.insert(0, f"... 日志过多，已省略 {self._log_dropped} 条 ...")
+            self._log_dropped = 0
+        if msgs:
+            try:
                 self.log_text.config(state='normal')
-                self.log_text.insert(tk.END, msg + "\n")
+                self.log_text.insert(tk.END, "\n".join(msgs) + "\n")
+                n = int(self.log_text.index('end-1c').split('.')[0])
+                if n > MAX_LOG_LINES:
+                    self.log_text.delete('1.0', f'{n - MAX_LOG_LINES + 1}.0')
                 self.log_text.see(tk.END)
                 self.log_text.config(state='disabled')
-        except: pass
-        self.root.after(100, self.update_log_display)
+            except: pass
+            self._log_idle_ticks = 0
+        else:
+            self._log_idle_ticks += 1
+        # 有日志时 100ms 刷新一次，空闲时逐步放慢，最慢 1s 一次
+        delay = min(1000, 100 * (1 + self._log_idle_ticks // 5))
+        self.root.after(delay, self.update_log_display)
 
     def clear_log(self):
         self.log_text.config(state='normal')
-        self.log_text.delete(1.0, tk.END)
+        self.log_text.replace('1.0', tk.END, '')
         self.log_text.config(state='disabled')
 
     def open_browser_for_cookie(self):
+        import webbrowser # 按需导入，加快启动
         webbrowser.open("https://i.mi.com/note/h5")
         self.log("🌐 已打开浏览器，请登录小米笔记。")
         self.cookie_status.config(text="正在监听剪贴板 (请复制请求头中的 Cookie)...", foreground="orange")
+        self._clip_seq = None
         self.check_clipboard_loop()
 
+    def read_clipboard(self):
+        """优先使用 Tk 自带的剪贴板读取，失败时再退回 pyperclip"""
+        try:
+            return self.root.clipboard_get()
+        except tk.TclError:
+            import pyperclip
+            return pyperclip.paste()
+
+    def is_xiaomi_cookie(self, content):
+        """判断剪贴板内容是否像小米 Cookie，先做最便宜的长度判断"""
+        n = len(content)
+        if n <= 50 or n > 16384: return False
+        return ";" in content and "serviceToken" in content
+
     def check_clipboard_loop(self):
-        """简单的剪贴板监听"""
+        """简单的剪贴板监听（Windows 下仅在剪贴板内容变化时才读取）"""
         try:
-            content = pyperclip.paste().strip()
-            if "serviceToken" in content and ";" in content and len(content) > 50:
-                self.cookie_var.set(content)
-                self.cookie_status.config(text="✅ 已成功捕获 Cookie！", foreground="green")
-                self.log("🎉 Cookie 自动捕获成功！")
-                return
+            seq = _GetClipboardSequenceNumber() if _GetClipboardSequenceNumber else None
+            if seq is None or seq != self._clip_seq:
+                self._clip_seq = seq
+                content = self.read_clipboard().strip()
+                if self.is_xiaomi_cookie(content):
+                    self.cookie_var.set(content)
+                    self.cookie_status.config(text="✅ 已成功捕获 Cookie！", foreground="green")
+                    self.log("🎉 Cookie 自动捕获成功！")
+                    return
         except: pass
         self.root.after(1000, self.check_clipboard_loop)
 
     def browse_path(self):
+        from tkinter import filedialog
         p = filedialog.askdirectory()
         if p: self.path_var.set(p)
 
     def start_sync_thread(self):
         if not self.cookie_var.get() or not self.path_var.get():
+            from tkinter import messagebox
             messagebox.showwarning("提示", "请先配置 Cookie 和 保存路径")
             return
             
@@ -180,6 +247,7 @@ class MiNoteGUI:
         threading.Thread(target=self.run_sync_logic, daemon=True).start()
 
     def run_sync_logic(self):
+        futures = {}
         try:
             self.log("🚀 初始化核心同步引擎...")
             # 实例化核心类，传入 self.log 作为回调
@@ -193,25 +261,47 @@ class MiNoteGUI:
             
             self.core_instance.setup_dirs()
             
-            # 获取列表
-            notes, folders = self.core_instance.fetch_note_list()
-            if not notes:
+            # 边翻页边处理：每拿到一页就把笔记交给线程池
+            folders = {'0': '未分类'}
+            worker = partial(self.core_instance.process_single_note, folder_map=folders)
+            deferred = [] # 所属文件夹尚未出现的笔记，等列表拉完、文件夹齐全后再处理
+            for entries in self.core_instance.iter_note_pages(folders):
+                for n in entries:
+                    if str(n.get('folderId', '0')) in folders:
+                        futures[self._pool.submit(worker, n)] = n
+                    else:
+                        deferred.append(n)
+            for n in deferred:
+                futures[self._pool.submit(worker, n)] = n
+
+            if not futures:
                 self.log("⚠️ 未获取到笔记，任务结束。")
             else:
-                self.log(f"📦 开始处理 {len(notes)} 条笔记 (4线程并发)...")
-                with ThreadPoolExecutor(max_workers=4) as pool:
-                    futures = [pool.submit(self.core_instance.process_single_note, (n, folders)) for n in notes]
-                    for f in futures:
-                        if self.core_instance.stop_flag: break
-                        f.result()
+                self.log(f"📦 列表获取完成，共 {len(futures)} 条笔记 ({self.workers}线程并发)...")
+                # 按完成顺序收集结果，停止时取消尚未开始的任务
+                for i, f in enumerate(as_completed(futures), 1):
+                    if self.core_instance.stop_flag:
+                        for p in futures: p.cancel()
+                        break
+                    f.result()
+                    self.root.after(0, self.set_progress, i, len(futures))
+                # 等待正在执行的任务收尾
+                wait(futures)
+                self.core_instance.flush_writes()
+                self.core_instance.save_manifest()
                         
             self.log("🎉 任务流程结束。")
             
         except Exception as e:
             self.log(f"❌ 发生致命错误: {e}")
         finally:
+            # 出错时也要等已开始的笔记处理完，再让写盘线程退出，否则它们的写入会丢失
+            for p in futures: p.cancel()
+            wait(futures)
+            if self.core_instance: self.core_instance.close()
             self.is_running = False
-            self.root.after(0, self.on_sync_finished)
+            try: self.root.after(0, self.on_sync_finished)
+            except (RuntimeError, tk.TclError): pass # 窗口已关闭
 
     def stop_sync(self):
         if self.core_instance:
@@ -219,18 +309,39 @@ class MiNoteGUI:
             self.log("🛑 正在停止... (等待当前任务完成)")
             self.stop_btn.config(state=tk.DISABLED)
 
+    def _on_close(self):
+        core = self.core_instance
+        if core: core.stop()
+        def cleanup():
+            # 排队中的笔记因 stop_flag 会立即返回，只需等进行中的笔记收尾，再写完已排队的笔记
+            self._pool.shutdown(wait=True)
+            if core: core.close()
+        # 收尾可能要等下载 / 重试数秒，放到后台 (非守护) 线程，窗口立即关闭，进程在写盘完成后才退出
+        threading.Thread(target=cleanup).start()
+        self.root.destroy()
+
+    def set_progress(self, done, total):
+        """拿到笔记总数后切换为确定进度模式，显示真实完成比例"""
+        if str(self.progress_bar.cget('mode')) != 'determinate':
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=total)
+        self.progress_bar['value'] = done
+
     def on_sync_finished(self):
         self.start_btn.config(state=tk.NORMAL)
         self.stop_btn.config(state=tk.DISABLED)
         self.progress_bar.stop()
+        self.progress_bar.config(mode='indeterminate', value=0)
         self.core_instance = None
 
 def main():
     root = tk.Tk()
-    try:
-        import ttkbootstrap as ttk
-        style = ttk.Style(theme="cosmo")
-    except: pass
+    # ttkbootstrap 会连带导入 Pillow，启动较慢；可通过环境变量跳过
+    if not os.environ.get("MINOTE_NO_TTKBOOTSTRAP"):
+        try:
+            import ttkbootstrap as ttk
+            style = ttk.Style(theme="cosmo")
+        except: pass
     app = MiNoteGUI(root)
     root.mainloop()
 
@@ -16,10 +16,51 @@ import json
 import os
 import re
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import html
 import random
-from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+import shutil
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# 可选依赖：安装了 orjson 时用它解析 JSON，否则退回标准库
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# --- 预编译正则 (每条笔记都会用到，避免重复查找/解析) ---
+_RE_TEXT_INDENT = re.compile(r'text\s*indent\s*=\s*\S+', re.IGNORECASE)
+_RE_CLASS = re.compile(r'class="[^"]+"')
+_RE_STYLE = re.compile(r'style="[^"]+"')
+_RE_CTRL = re.compile(r'[\x00-\x1f]')
+_RE_SANITIZE = re.compile(r'[\\/*?:"<>|]')
+_RE_TAG = re.compile(r'<[^>]+>')
+_RE_BREAK = re.compile(r'<br/?>|</div>|</p>')
+_RE_FILEID = re.compile(r'fileid=["\']?([\w\.\-]+)["\']?', re.I)
+_RE_SMILEY = re.compile(r'☺\s*([\w\.\-]+)')
+_RE_FID_COLON = re.compile(r'<fileId:(\d+)')
+# 一次扫描匹配所有资源占位: <sound fileid=..>、<img fileid=..>、<fileId:..>、<fileId:../>、☺ ID...
+_RE_ANY_FID = re.compile(r'<[^>]*?fileid[=:]\s*["\']?(?P<tfid>[\w\.\-]+)[^>]*>|☺\s*(?P<efid>[\w\.\-]+).*', re.I)
+
+def _strip_tags(text):
+    """去除 HTML 标签。最后一个 '>' 之后不可能再有完整标签，直接原样保留，
+    避免正则在大量未闭合的 '<' 上逐个扫描到文本末尾 (O(n²))"""
+    end = text.rfind('>') + 1
+    return _RE_TAG.sub('', text[:end]) + text[end:]
+
+# 本地已下载资源可能使用的扩展名
+_ASSET_EXTS = (".jpg", ".png", ".gif", ".mp3", ".amr", ".wav", ".m4a", ".webp")
+# 同时向小米服务器发出的最大请求数 (与线程数解耦，线程再多也不会压垮服务器)
+MAX_CONCURRENT_REQUESTS = 8
+# fetch_note_detail 在服务器返回 304 (笔记未修改) 时的返回值
+_NOT_MODIFIED = object()
+# 同步清单文件名 (保存在笔记库根目录)，记录每条笔记上次同步时的 modifyDate
+MANIFEST_NAME = ".sync_manifest.json"
 
 class MiNoteSyncCore:
     def __init__(self, cookie, save_path, use_date_prefix=True, log_callback=None):
@@ -31,12 +72,38 @@ class MiNoteSyncCore:
             self.cookie = cookie.replace('\n', '').replace('\r', '').strip()
         else:
             self.cookie = ""
+        # 请求头在整个同步过程中不变，只构建一次
+        self._headers = {
+            "Cookie": self.cookie,
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+            "Referer": "https://i.mi.com/note/h5",
+            "Origin": "https://i.mi.com"
+        }
             
         self.vault_root = save_path
         self.assets_dir = os.path.join(save_path, "assets")
         self.use_date_prefix = use_date_prefix # 新增配置项
         self.log_callback = log_callback or print
         self.stop_flag = False
+        self._name_cache = {} # 标题/文件夹名 -> 清洗后的文件名
+        # 所有笔记共享的资源下载线程池，同时也限制了对服务器的并发下载数
+        self._dl_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="minote-dl")
+        self._fid_futures = {} # fid -> 下载任务，多条笔记引用同一资源时只下载一次
+        self._fid_lock = threading.Lock()
+        self._assets_index = {} # fid -> 本地已存在的资源文件名，由 setup_dirs 扫描建立
+        self._manifest = {} # 笔记 id -> 上次同步时的 modifyDate
+        self._md_index = {} # 已存在的 .md 完整路径 -> 文件大小，由 setup_dirs 扫描建立
+        self._created_dirs = set() # 本次同步中已确保存在的文件夹
+        self._http_slots = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+        # 写盘交给单独的线程，网络线程不被磁盘 / 杀毒软件扫描拖慢
+        self._writer_q = queue.Queue(maxsize=64)
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+        # 复用同一个 Session，保持与 i.mi.com 的长连接，避免每个请求重新 TLS 握手
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0))
+        self.session.headers.update(self.get_headers())
 
     def log(self, message):
         self.log_callback(message)
@@ -45,20 +112,34 @@ class MiNoteSyncCore:
         self.stop_flag = True
         self.log("⚠️ 收到停止指令，正在结束当前任务...")
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """写完已排队的笔记并释放写盘线程与网络连接；同步结束 (或窗口关闭) 时调用，可重复调用"""
+        self._writer_q.put(None) # 通知写盘线程退出，退出前会写完已排队的笔记
+        self._writer.join()
+        # 丢弃尚未开始的下载，等待进行中的下载结束后再关闭 Session
+        # (shutdown 的 cancel_futures 参数需要 Python 3.9，这里手动取消以兼容 3.7)
+        with self._fid_lock:
+            for f in self._fid_futures.values(): f.cancel()
+        self._dl_pool.shutdown(wait=True)
+        self.session.close()
+
     def get_headers(self):
-        return {
-            "Cookie": self.cookie,
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-            "Referer": "https://i.mi.com/note/h5",
-            "Origin": "https://i.mi.com"
-        }
+        return self._headers
 
-    def request_with_retry(self, url, retries=3, stream=False):
+    def request_with_retry(self, url, retries=3, stream=False, headers=None):
+        """:param headers: 本次请求额外附加的请求头 (与 Session 默认请求头合并)"""
         for i in range(retries):
             if self.stop_flag: return None
             try:
-                response = requests.get(url, headers=self.get_headers(), stream=stream, timeout=15)
-                if response.status_code in [200, 404]:
+                with self._http_slots:
+                    response = self.session.get(url, headers=headers, stream=stream, timeout=15)
+                if response.status_code in [200, 304, 404]:
                     return response
                 elif response.status_code == 401:
                     self.log("❌ Cookie 已失效 (401 Unauthorized)")
@@ -76,33 +157,71 @@ class MiNoteSyncCore:
         return None
 
     def setup_dirs(self):
-        if not os.path.exists(self.vault_root): os.makedirs(self.vault_root)
-        if not os.path.exists(self.assets_dir): os.makedirs(self.assets_dir)
+        os.makedirs(self.assets_dir, exist_ok=True) # 同时创建 vault_root
+        # 一次性扫描 assets 目录，代替每个资源逐个扩展名 stat
+        with os.scandir(self.assets_dir) as it:
+            for de in it:
+                stem, ext = os.path.splitext(de.name)
+                if ext in _ASSET_EXTS and de.is_file() and de.stat().st_size > 1000:
+                    self._assets_index[stem] = de.name
+        # 同样一次性扫描已同步的笔记，增量跳过判断只查内存
+        # 笔记只会写在 vault_root/<文件夹>/ 下，只扫描这一层，不遍历整个 Obsidian 库
+        # (文件夹名可能以 "." 开头或恰好叫 assets，因此不按名称跳过)
+        dirs = [self.vault_root]
+        with os.scandir(self.vault_root) as it:
+            dirs += [de.path for de in it if de.is_dir()]
+        for d in dirs:
+            try:
+                with os.scandir(d) as it:
+                    for de in it:
+                        if de.name.endswith(".md") and de.is_file():
+                            self._md_index[de.path] = de.stat().st_size
+            except OSError: continue # 无权限或扫描期间被删除的目录
+        self.load_manifest()
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.vault_root, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                self._manifest = json.load(f)
+        except: self._manifest = {}
+
+    def save_manifest(self):
+        """同步结束后调用，把各笔记的 modifyDate 写回清单"""
+        path = os.path.join(self.vault_root, MANIFEST_NAME)
+        try:
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(dict(self._manifest), f)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            self.log(f"⚠️ 同步清单保存失败: {e}")
 
     def clean_css_garbage(self, text):
         """【加强版】专门处理 CSS 样式残留"""
         if not text: return ""
         # 针对 text indent=1cpu 这种连体怪进行更宽泛的匹配
         # 匹配 text indent= 后面跟着的一串非空字符
-        text = re.sub(r'text\s*indent\s*=\s*\S+', '', text, flags=re.IGNORECASE)
-        text = re.sub(r'class="[^"]+"', '', text)
-        text = re.sub(r'style="[^"]+"', '', text)
+        text = _RE_TEXT_INDENT.sub('', text)
+        text = _RE_CLASS.sub('', text)
+        text = _RE_STYLE.sub('', text)
         return text.strip()
 
     def sanitize_filename(self, name):
         if not name: return "未命名"
+        # 同一文件夹下的每条笔记都会清洗一次文件夹名，命中缓存直接返回
+        cached = self._name_cache.get(name)
+        if cached is not None: return cached
+        raw = name
         name = self.clean_css_garbage(name) # 先洗代码
-        name = re.sub(r'[\x00-\x1f]', '', name)
-        name = re.sub(r'[\\/*?:"<>|]', "", name).replace('\n', ' ').strip()
+        name = _RE_CTRL.sub('', name)
+        name = _RE_SANITIZE.sub("", name).replace('\n', ' ').strip()
+        self._name_cache[raw] = name[:50]
         return name[:50]
 
     def clean_content(self, content):
         if not content: return ""
-        content = content.replace("<br>", "\n").replace("<br/>", "\n")
-        content = content.replace("</div>", "\n").replace("</p>", "\n")
-        content = re.sub(r'<text[^>]*>(.*?)</text>', r'\1', content, flags=re.S)
-        content = re.sub(r'<background[^>]*>(.*?)</background>', r'\1', content, flags=re.S)
-        content = re.sub(r'<[^>]+>', '', content)
+        content = _RE_BREAK.sub("\n", content)
+        # <text>/<background> 只需去掉标签保留内容，通用的去标签即可完成
+        content = _strip_tags(content)
         content = self.clean_css_garbage(content) # CSS 清洗
         content = html.unescape(content)
         return content.strip()
@@ -118,33 +237,78 @@ class MiNoteSyncCore:
         return ".jpg"
 
     def download_resource(self, fid):
-        for ext in [".jpg", ".png", ".gif", ".mp3", ".amr", ".wav", ".m4a", ".webp"]:
-            fname = f"{fid}{ext}"
-            fpath = os.path.join(self.assets_dir, fname)
-            if os.path.exists(fpath) and os.path.getsize(fpath) > 1000:
-                return fname
+        if fid in self._assets_index:
+            return self._assets_index[fid]
 
         types = ["note_img", "file", "note_voice", "note_audio"]
         for tp in types:
             if self.stop_flag: return None
             url = f"https://i.mi.com/file/full?type={tp}&fileid={fid}"
+            # stream=True 时只读取了响应头，落选的接口不会下载响应体
             r = self.request_with_retry(url, retries=2, stream=True)
-            if r and r.status_code == 200:
-                if int(r.headers.get('content-length', 0)) < 1000: continue
+            if r is None: continue # 注意 404 的 Response 布尔值为 False，也要进入下面的读完分支
+            with r: # 未读完的响应在退出时会直接断开连接，不会回到连接池
+                if r.status_code != 200 or int(r.headers.get('content-length', 0)) < 1000:
+                    # 落选接口的响应体很小 (错误页)，读完后连接即可复用；长度未知的仍直接断开
+                    if r.status_code != 200 or 'content-length' in r.headers: r.content
+                    continue
                 real_ext = self.get_real_extension(r)
                 fname = f"{fid}{real_ext}"
                 try:
                     with open(os.path.join(self.assets_dir, fname), "wb") as f:
-                        for chunk in r.iter_content(1024): f.write(chunk)
+                        r.raw.decode_content = True
+                        shutil.copyfileobj(r.raw, f, 1 << 16) # 64KB 分块写入
+                    self._assets_index[fid] = fname
                     return fname
                 except Exception as e:
                     self.log(f"    ⚠️ 资源写入失败: {e}")
         return None
 
+    def submit_download(self, fid):
+        """提交资源下载任务；同一 fid 在本次同步中共享同一个 Future"""
+        with self._fid_lock:
+            future = self._fid_futures.get(fid)
+            if future is None:
+                future = self._fid_futures[fid] = self._dl_pool.submit(self.download_resource, fid)
+            return future
+
+    def _writer_loop(self):
+        while True:
+            item = self._writer_q.get()
+            if item is None:
+                self._writer_q.task_done()
+                break
+            md_path, md_text, mtime_ts, nid, modify_date, title = item
+            try:
+                # 先写临时文件再替换，中途退出也不会留下写了一半的笔记
+                with open(md_path + ".tmp", "wb") as f:
+                    f.write(md_text.encode("utf-8"))
+                os.replace(md_path + ".tmp", md_path)
+                try: os.utime(md_path, (mtime_ts, mtime_ts))
+                except: pass
+                self._manifest[str(nid)] = modify_date
+                self.log(f"    ✅ [成功] {title}")
+            except Exception as e:
+                self.log(f"    ❌ [错误] 写入笔记 {nid} 失败: {e}")
+            finally:
+                self._writer_q.task_done()
+
+    def flush_writes(self):
+        """等待写盘线程处理完所有已提交的笔记"""
+        self._writer_q.join()
+
     def fetch_note_list(self):
-        self.log("📡 正在连接小米云服务...")
         all_entries = []
         folders_map = {'0': '未分类'}
+        for entries in self.iter_note_pages(folders_map):
+            all_entries.extend(entries)
+        return all_entries, folders_map
+
+    def iter_note_pages(self, folders_map):
+        """逐页拉取笔记列表，每拿到一页就 yield 该页笔记；文件夹信息随翻页写入 folders_map。
+        调用方可以边翻页边处理笔记，不必等整个列表拉完"""
+        self.log("📡 正在连接小米云服务...")
+        total = 0
         sync_tag = None
         current_page = 0
         
@@ -157,7 +321,7 @@ class MiNoteSyncCore:
             if not r: break
             
             try:
-                json_data = r.json()
+                json_data = _json_loads(r.content)
                 data = json_data.get('data', {})
                 for f in data.get('folders', []):
                     folders_map[str(f.get('id'))] = f.get('subject')
@@ -165,38 +329,48 @@ class MiNoteSyncCore:
                 entries = data.get('entries', [])
                 if not entries: break
                 
-                all_entries.extend(entries)
-                self.log(f"    已索引 {len(all_entries)} 条笔记 (第 {current_page} 页)...")
+                total += len(entries)
+                self.log(f"    已索引 {total} 条笔记 (第 {current_page} 页)...")
+                yield entries
                 
                 sync_tag = data.get('syncTag')
                 if not sync_tag or current_page >= 500: break
-                time.sleep(0.5)
+                # 不再固定休眠；仅在服务器要求时等待 (429 等错误由 request_with_retry 退避重试)
+                retry_after = r.headers.get('Retry-After')
+                if retry_after:
+                    try: time.sleep(min(float(retry_after), 10))
+                    except ValueError: time.sleep(0.5)
             except Exception as e:
                 self.log(f"❌ 解析列表失败: {e}")
                 break
-        
-        return all_entries, folders_map
 
-    def fetch_note_detail(self, note_id):
+    def fetch_note_detail(self, note_id, since=None):
+        """:param since: 上次同步时笔记的修改时间戳 (秒)；提供时发送条件请求，未修改则返回 _NOT_MODIFIED"""
         url = f"https://i.mi.com/note/note/{note_id}/?ts={int(time.time()*1000)}"
-        r = self.request_with_retry(url, retries=3)
+        headers = {"If-Modified-Since": formatdate(since, usegmt=True)} if since else None
+        r = self.request_with_retry(url, retries=3, headers=headers)
+        if r and r.status_code == 304:
+            return _NOT_MODIFIED
         if r and r.status_code == 200:
-            return r.json().get('data', {}).get('entry')
+            return _json_loads(r.content).get('data', {}).get('entry')
         return None
 
-    def process_single_note(self, args):
+    def process_single_note(self, entry, folder_map):
+        """笔记由后台写盘线程异步写入；调用方结束前必须调用 close() (或使用 with 语句)，否则排队中的笔记会丢失"""
         if self.stop_flag: return
 
-        entry, folder_map = args
         nid = entry['id']
         
         try:
             folder_id = str(entry.get('folderId', '0'))
             folder_name = folder_map.get(folder_id, "未分类")
             
+            # 空字符串 / 缺失时直接跳过解析
             extra = {}
-            try: extra = json.loads(entry.get('extraInfo', '{}'))
-            except: pass
+            extra_raw = entry.get('extraInfo')
+            if extra_raw:
+                try: extra = _json_loads(extra_raw)
+                except: pass
             
             # 1. 提取标题并【立刻清洗】
             raw_title = extra.get('title') or entry.get('snippet', '无标题')
@@ -216,59 +390,83 @@ class MiNoteSyncCore:
                 filename = f"{title}_{str(nid)[-4:]}.md"
                 
             md_path = os.path.join(target_dir, filename)
+            modify_date = entry.get('modifyDate')
+            since = None
             
-            if os.path.exists(md_path) and os.path.getsize(md_path) > 0:
-                self.log(f"    ⏭️ [跳过] {title}")
-                return 
+            if self._md_index.get(md_path, 0) > 0:
+                # 清单中无记录 (旧版本同步的文件) 或修改时间未变，视为已是最新
+                if self._manifest.get(str(nid), modify_date) == modify_date:
+                    self._manifest[str(nid)] = modify_date
+                    self.log(f"    ⏭️ [跳过] {title}")
+                    return 
+                # 用清单中记录的 modifyDate 发送条件请求；不用文件 mtime，
+                # 它可能被 Obsidian / git / 复制等外部操作改动
+                synced = self._manifest.get(str(nid))
+                if isinstance(synced, (int, float)): since = synced / 1000
 
-            full_note = self.fetch_note_detail(nid)
+            full_note = self.fetch_note_detail(nid, since)
+            if full_note is _NOT_MODIFIED:
+                # 列表的 modifyDate 已表明笔记有改动，304 可能来自 CDN 缓存或时钟偏差：
+                # 不更新清单，下次同步会再次检查，避免把改动永久标记为已同步
+                self.log(f"    ⏭️ [未修改] {title}")
+                return
             if not full_note:
                 self.log(f"    ⚠️ [失败] 无法获取详情: {title}")
                 return
+            if since: self.log(f"    🔄 [更新] {title}")
 
             content = full_note.get('content', '')
-            if not os.path.exists(target_dir): os.makedirs(target_dir, exist_ok=True)
+            if target_dir not in self._created_dirs:
+                os.makedirs(target_dir, exist_ok=True)
+                self._created_dirs.add(target_dir)
             
             # --- 资源提取 (省略，逻辑不变) ---
             ids = set()
-            ids.update(re.findall(r'fileid=["\']?([\w\.\-]+)["\']?', content, re.I))
-            ids.update(re.findall(r'☺\s*([\w\.\-]+)', content))
-            ids.update(re.findall(r'<fileId:(\d+)', content))
-            ids.update(re.findall(r'<sound[^>]+fileid=["\']?([\w\.\-]+)["\']?', content, re.I))
+            ids.update(_RE_FILEID.findall(content))
+            ids.update(_RE_SMILEY.findall(content))
+            ids.update(_RE_FID_COLON.findall(content)) # <sound fileid=..> 已被上面的 fileid= 覆盖
             
             voice_list = extra.get('voice_list') or extra.get('audio_list') or []
             voice_ids = [v['fileId'] for v in voice_list if v.get('fileId')]
             ids.update(voice_ids)
             
-            if full_note.get('setting'):
+            setting_raw = full_note.get('setting')
+            if setting_raw:
                 try:
-                    for res in json.loads(full_note.get('setting', '{}')).get('data', []):
-                        if res.get('fileId'): ids.add(res.get('fileId'))
+                    for res in _json_loads(setting_raw).get('data', ()):
+                        fid = res.get('fileId')
+                        if fid: ids.add(fid)
                 except: pass
 
+            # 同一笔记的多个资源并行下载
             replacements = {}
-            for fid in ids:
-                if self.stop_flag: return
-                fname = self.download_resource(fid)
-                if fname: replacements[fid] = f"![[{fname}]]"
+            futures = {self.submit_download(fid): fid for fid in ids}
+            for f in as_completed(futures):
+                fname = f.result()
+                if fname: replacements[futures[f]] = f"![[{fname}]]"
+            if self.stop_flag: return
 
             # --- 内容清洗 ---
             content = self.clean_content(content)
-            for fid, link in replacements.items():
-                content = re.sub(fr'<sound[^>]*{re.escape(fid)}[^>]*\/?>', f"\n{link}\n", content)
-                content = re.sub(fr'<[^>]*{re.escape(fid)}[^>]*>', f"\n{link}\n", content)
-                content = re.sub(fr'☺\s*{re.escape(fid)}.*', f"\n{link}\n", content)
-                content = content.replace(f"<fileId:{fid}>", f"\n{link}\n")
-                content = content.replace(f"<fileId:{fid}/>", f"\n{link}\n")
+
+            substituted = set() # 已在正文中嵌入的资源 ID
+
+            def replace_fid(m):
+                fid = m.group('tfid') or m.group('efid')
+                link = replacements.get(fid)
+                if not link: return m.group(0)
+                substituted.add(fid)
+                return f"\n{link}\n"
+
+            if replacements:
+                content = _RE_ANY_FID.sub(replace_fid, content)
 
             if voice_ids:
-                appended = False
-                for vid in voice_ids:
-                    if vid not in content and vid in replacements:
-                        if not appended:
-                            content += "\n\n---\n**🎙️ 附件录音：**\n"
-                            appended = True
-                        content += f"{replacements[vid]}\n"
+                # 正文中没有嵌入的录音统一追加到末尾，拼好后一次性连接
+                tail = [f"{replacements[vid]}\n" for vid in dict.fromkeys(voice_ids)
+                        if vid not in substituted and vid in replacements]
+                if tail:
+                    content += "\n\n---\n**🎙️ 附件录音：**\n" + "".join(tail)
 
             # --- 文件写入 ---
             ctime_struct = time.localtime(full_note['createDate']/1000)
@@ -278,21 +476,14 @@ class MiNoteSyncCore:
             
             md_text = f"---\nid: {nid}\ncreated: {ctime_str}\nupdated: {mtime_str}\ntitle: \"{title}\"\nfolder: \"{folder_name}\"\n---\n\n{content}\n"
             
-            with open(md_path, "w", encoding="utf-8") as f:
-                f.write(md_text)
-                
-            try:
-                mtime_ts = full_note['modifyDate'] / 1000.0
-                os.utime(md_path, (mtime_ts, mtime_ts))
-            except: pass
-
-            self.log(f"    ✅ [成功] {title}")
+            mtime_ts = full_note['modifyDate'] / 1000.0
+            self._writer_q.put((md_path, md_text, mtime_ts, nid, modify_date, title))
             
         except Exception as e:
             self.log(f"    ❌ [错误] 处理笔记 {nid} 失败: {e}")
 
 def main():
-    print("请运行 gui.py 或自行调用 MiNoteSyncCore 类")
+    print("请运行 gui.py 或自行调用 MiNoteSyncCore 类 (用 with 语句或在结束时调用 close()，确保笔记写入磁盘)")
 
 if __name__ == "__main__":
     main()